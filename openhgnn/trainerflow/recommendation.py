@@ -1,14 +1,25 @@
 import copy
 import json
-import dgl
+import warnings
 import numpy as np
 import torch as th
 from tqdm import tqdm
 import torch
+import torch.nn.functional as F
 from openhgnn.models import build_model
 from . import BaseFlow, register_flow
 from ..utils import extract_embed, EarlyStopping
 
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional, the CSR metrics then fall back to vectorized NumPy
+    njit = None
+
+# largest user x item catalog whose held-out interactions are kept as a dense boolean mask
+DENSE_MASK_LIMIT = 2 ** 24
+# largest dense -inf penalty, in bytes, kept on the device to mask training interactions
+DENSE_PENALTY_LIMIT = 2 ** 28
+
 
 @register_flow("recommendation")
 class Recommendation(BaseFlow):
@@ -31,6 +42,7 @@ class Recommendation(BaseFlow):
         self.val_metric = 'recall'
         # self.topk_list = [5, 10, 20, 50, 100]
         self.topk = 20
+        self.eval_chunk = 4096
         self.evaluator = self.task.get_evaluator(self.metric)
 
         self.optimizer = (
@@ -42,36 +54,55 @@ class Recommendation(BaseFlow):
         self.num_neg = self.task.dataset.num_neg
         self.num_user = self.hg.num_nodes('user')
         self.num_item = self.hg.num_nodes('item')
+        # log2 position discount shared by every user's DCG
+        self.discount = 1.0 / np.log2(np.arange(2, self.num_item + 2, dtype=np.float32))
 
 
-        self.train_eid_dict = {
-            etype: self.hg.edges(etype=etype, form='eid')
-            for etype in self.hg.canonical_etypes}
         # self.positive_graph = self.hg
         # self.negative_graph = self.task.dataset.neg_g.to(self.device)
 
     def preprocess(self):
         self.train_hg, self.val_hg, self.test_hg = self.task.get_idx()
         self.train_neg_hg = self.task.dataset.construct_negative_graph(self.train_hg)
+        neg_src, neg_dst = self.train_neg_hg.edges(etype=self.target_link)
+        if th.device(self.device).type == 'cuda':
+            neg_src = neg_src.pin_memory().to(self.device, non_blocking=True)
+            neg_dst = neg_dst.pin_memory().to(self.device, non_blocking=True)
+        self.negative_edges = (neg_src, neg_dst)
+        if self.num_user * self.num_item <= DENSE_MASK_LIMIT:
+            self.val_items = user_item_mask(self.val_hg, self.num_user, self.num_item)
+            self.test_items = user_item_mask(self.test_hg, self.num_user, self.num_item)
+        else:
+            self.val_items = user_item_csr(self.val_hg, self.num_user, self.num_item)
+            self.test_items = user_item_csr(self.test_hg, self.num_user, self.num_item)
+        self.val_gt = num_test_items(self.val_items)
+        self.test_gt = num_test_items(self.test_items)
         self.train_hg = self.train_hg.to(self.device)
-        self.val_hg = self.val_hg.to(self.device)
-        self.test_hg = self.test_hg.to(self.device)
-        self.negative_graph = self.train_neg_hg.to(self.device)
         self.positive_graph = self.train_hg.edge_type_subgraph([self.target_link])
-        # generage complete user-item graph for evaluation
-        src, dst = th.arange(self.num_user), th.arange(self.num_item)
-        src = src.repeat_interleave(self.num_item)
-        dst = dst.repeat(self.num_user)
-        self.eval_graph = dgl.heterograph({('user', 'user-item', 'item'): (src, dst)}, {'user': self.num_user, 'item': self.num_item}).to(self.device)
+        train_u, train_i = self.positive_graph.edges(etype='user-item')
+        # in edge id order, aligned with the consecutive negatives of each positive edge
+        self.positive_edges = (train_u, train_i)
+        self.bpr_loss_fn = self.compile_bpr_loss(len(train_u))
+        order = th.argsort(train_u)
+        self.train_u, self.train_i = train_u[order], train_i[order]
+        self.train_indptr = [0] + th.bincount(train_u, minlength=self.num_user).cumsum(0).tolist()
+        # on small catalogs the mask is a dense -inf penalty added to the single score block; it stays on
+        # the device for the whole run, doubling evaluation memory within DENSE_PENALTY_LIMIT
+        self.pos_penalty = None
+        if self.num_user <= self.eval_chunk and self.num_user * self.num_item * 4 <= DENSE_PENALTY_LIMIT:
+            self.pos_penalty = th.sparse_coo_tensor(
+                th.stack([train_u, train_i]), th.full((len(train_u),), float('-inf'), device=train_u.device),
+                (self.num_user, self.num_item)).to_dense()
+        # needed even without node features: HeteroFeature then builds the learnable embeddings
         self.preprocess_feature()
         return
 
     def train(self):
         self.preprocess()
-        epoch_iter = tqdm(range(self.max_epoch))
         stopper = EarlyStopping(self.args.patience, self._checkpoint)
 
-        for epoch in tqdm(range(self.max_epoch), ncols=80):
+        epoch_iter = tqdm(range(self.max_epoch), ncols=80)
+        for epoch in epoch_iter:
             loss = 0
             if self.args.mini_batch_flag:
                 loss = self._mini_train_step()
@@ -100,34 +131,47 @@ class Recommendation(BaseFlow):
         return result
         # return dict(Test_metric=test_metric_dic, Val_metric=val_metric_dic)
 
-    def loss_calculation(self, positive_graph, negative_graph, embedding):
-        p_score = self.ScorePredictor(positive_graph, embedding).repeat_interleave(self.num_neg)
-        n_score = self.ScorePredictor(negative_graph, embedding)
-        bpr_loss = -torch.log(torch.sigmoid(p_score - n_score)).mean()
+    def loss_calculation(self, positive_edges, negative_edges, embedding):
+        p_score = self.ScorePredictor(positive_edges, embedding)
+        # the negatives of each positive edge are consecutive, (num_pos, num_neg)
+        n_score = self.ScorePredictor(negative_edges, embedding).view(-1, self.num_neg)
+        loss = self.bpr_loss_fn(p_score, n_score)
+        if self.reg_weight == 0:
+            return loss
         reg_loss = self.regularization_loss(embedding)
-        return bpr_loss + self.reg_weight * reg_loss
-
-    def ScorePredictor(self, edge_subgraph, x):
-        with edge_subgraph.local_scope():
-            for ntype in ['user', 'item']:
-                edge_subgraph.nodes[ntype].data['x'] = x[ntype]
-            edge_subgraph.apply_edges(
-                dgl.function.u_dot_v('x', 'x', 'score'), etype='user-item')
-            score = edge_subgraph.edges['user-item'].data['score']
-            return score.squeeze()
+        return loss + self.reg_weight * reg_loss
+
+    def ScorePredictor(self, edges, x):
+        # dot product of the user and item embeddings at both ends of every (src, dst) user-item edge
+        src, dst = edges
+        return (x['user'][src] * x['item'][dst]).sum(-1)
+
+    def compile_bpr_loss(self, num_pos):
+        if not hasattr(torch, 'compile') or th.device(self.device).type != 'cuda':
+            return bpr_loss
+        try:
+            import torch._dynamo
+            if hasattr(torch._dynamo, 'is_dynamo_supported') and not torch._dynamo.is_dynamo_supported():
+                return bpr_loss
+            compiled = torch.compile(bpr_loss)
+            # Inductor builds the forward and backward kernels lazily, so both are run once here
+            p_score = th.zeros(num_pos, device=self.device, requires_grad=True)
+            n_score = th.zeros(num_pos, self.num_neg, device=self.device, requires_grad=True)
+            compiled(p_score, n_score).backward()
+        except (ImportError, RuntimeError) as e:
+            warnings.warn(f"torch.compile failed for the BPR loss, using the eager loss instead: {e}")
+            return bpr_loss
+        return compiled
 
     def regularization_loss(self, embedding):
-        reg_loss = th.zeros(1, 1, device=self.device)
-        for e in embedding.values():
-            reg_loss += th.mean(e.pow(2))
-        return reg_loss
+        return th.stack([e.square().mean() for e in embedding.values()]).sum()
 
     def _full_train_step(self):
         self.model.train()
         h_dict = self.input_feature()
         embedding = self.model(self.train_hg, h_dict)
 
-        loss = self.loss_calculation(self.positive_graph, self.negative_graph, embedding)
+        loss = self.loss_calculation(self.positive_edges, self.negative_edges, embedding)
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
@@ -137,9 +181,9 @@ class Recommendation(BaseFlow):
     def _test_step(self, split=None, logits=None):
         self.model.eval()
         if split == 'val':
-            test_graph = self.val_hg
+            test_items, gt = self.val_items, self.val_gt
         elif split == 'test':
-            test_graph = self.test_hg
+            test_items, gt = self.test_items, self.test_gt
         else:
             raise ValueError('split must be in [val, test]')
         
@@ -147,25 +191,27 @@ class Recommendation(BaseFlow):
             h_dict = self.input_feature()
             embedding = self.model(self.hg, h_dict)
 
-            score_matrix = self.ScorePredictor(self.eval_graph, embedding)
-            score_matrix = score_matrix.detach().cpu().numpy()
-            score_matrix = np.reshape(score_matrix, (self.num_user, self.num_item))
-
-            train_u, train_i = self.positive_graph.edges(etype='user-item')[0].cpu().numpy(), self.positive_graph.edges(etype='user-item')[1].cpu().numpy()
-            score_matrix[train_u, train_i] = np.NINF
-            ind = np.argpartition(score_matrix, -self.topk) # (num_users, num_items)
-            ind = ind[:, -self.topk:] # (num_users, k), indicating non-ranked rec list 
-            arr_ind = score_matrix[np.arange(self.num_user)[:, None], ind]
-            arr_ind_argsort = np.argsort(arr_ind)[np.arange(self.num_user), ::-1]
-            pred_list = ind[np.arange(len(score_matrix))[:, None], arr_ind_argsort] # (num_uses, k)
+            item_emb = embedding['item'].transpose(0, 1)
+            pred_list = []
+            for start in range(0, self.num_user, self.eval_chunk):
+                end = min(start + self.eval_chunk, self.num_user)
+                score_matrix = embedding['user'][start:end] @ item_emb
+                if self.pos_penalty is not None:
+                    score_matrix += self.pos_penalty
+                else:
+                    pos = slice(self.train_indptr[start], self.train_indptr[end])
+                    score_matrix[self.train_u[pos] - start, self.train_i[pos]] = float('-inf')
+                pred_list.append(th.topk(score_matrix, self.topk, dim=1, sorted=True).indices)
+            pred_list = th.cat(pred_list).cpu().numpy()
+            hits = hit_matrix(pred_list, test_items, self.topk)
 
             metric_dic = {}
 
             for m in self.metric:
                 if m == 'recall':
-                    metric_k = recall_at_k(pred_list, test_graph, self.topk)
+                    metric_k = recall_at_k(hits, gt)
                 elif m == 'ndcg':
-                    metric_k = ndcg_at_k(pred_list, test_graph, self.topk)
+                    metric_k = ndcg_at_k(hits, gt, self.discount)
                 else:
                     raise NotImplementedError
                 metric_dic[m] = metric_k
@@ -217,40 +263,93 @@ class Recommendation(BaseFlow):
         # return metric
 
 
-def recall_at_k(pred_list, test_graph, k):
-    sum = 0.0
-    test_users = 0
-    for user in range(test_graph.num_nodes('user')):
-        test_items_set = set(test_graph.successors(user, etype='user-item').cpu().numpy())
-        pred_items_set = set(pred_list[user][:k])
-        if len(test_items_set) != 0:
-            sum += len(test_items_set & pred_items_set) / float(len(test_items_set))
-            test_users += 1
-    return sum / test_users
-
-def ndcg_at_k(pred_list, test_graph, k):
-    ndcg = []
-    for user in range(test_graph.num_nodes('user')):
-        test_items_set = set(test_graph.successors(user, etype='user-item').cpu().numpy())
-        pred_items_set = pred_list[user][:k]
-        hit_list = [1 if i in pred_items_set else 0 for i in test_items_set]
-        GT = len(test_items_set)
-        if GT >= k:
-            ideal_hit_list = [1] * k
-        else:
-            ideal_hit_list = [1] * GT + [0] * (k - GT)
-        # idcg = compute_DCG(sorted(hit_list, reverse=True))
-        idcg = compute_DCG(ideal_hit_list)
-        if idcg:
-            ndcg.append(compute_DCG(hit_list) / idcg)
-    return np.mean(ndcg)
-
-def compute_DCG(l):
-    l = np.array(l)
-    if l.size:
-        return np.sum(np.subtract(np.power(2, l), 1) / np.log2(np.arange(2, l.size + 2)))
-    else:
-        return 0.0
+def user_item_mask(graph, num_user, num_item):
+    u, i = graph.edges(etype='user-item')
+    mask = np.zeros((num_user, num_item), dtype=bool)
+    mask[u.cpu().numpy(), i.cpu().numpy()] = True
+    return mask
+
+def user_item_csr(graph, num_user, num_item):
+    u, i = graph.edges(etype='user-item')
+    # unique (user, item) pairs sorted by user then item, duplicates count once as in the dense mask
+    keys = np.unique(u.cpu().numpy() * num_item + i.cpu().numpy())
+    indptr = np.zeros(num_user + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys // num_item, minlength=num_user), out=indptr[1:])
+    # items of every user are sorted, so membership is a binary search
+    return indptr, keys % num_item
+
+def _csr_hits_loop(pred_list, indptr, indices, k):
+    num_user = len(indptr) - 1
+    hits = np.zeros((num_user, k), dtype=np.float32)
+    for u in prange(num_user):
+        items = indices[indptr[u]:indptr[u + 1]]
+        for j in range(k):
+            pos = np.searchsorted(items, pred_list[u, j])
+            if pos < len(items) and items[pos] == pred_list[u, j]:
+                hits[u, j] = 1.0
+    return hits
+
+def _csr_hits_numpy(pred_list, indptr, indices, k):
+    num_user = len(indptr) - 1
+    hits = np.zeros((num_user, k), dtype=np.float32)
+    if len(indices) == 0:
+        return hits
+    # one binary search over globally sorted (user, item) keys replaces the per-user loop
+    width = max(indices.max(), pred_list.max()) + 1
+    keys = np.repeat(np.arange(num_user), np.diff(indptr)) * width + indices
+    query = np.arange(num_user)[:, None] * width + pred_list[:, :k]
+    pos = np.searchsorted(keys, query).clip(max=len(keys) - 1)
+    hits[keys[pos] == query] = 1.0
+    return hits
+
+_csr_hits = njit(parallel=True)(_csr_hits_loop) if njit is not None else _csr_hits_numpy
+
+def num_test_items(test_items):
+    if isinstance(test_items, tuple):
+        return np.diff(test_items[0])
+    return test_items.sum(1)
+
+def hit_matrix(pred_list, test_items, k):
+    """Return the (num_users, k) hits of pred_list.
+
+    test_items is either a dense boolean user-item mask or an (indptr, indices) CSR pair,
+    and both layouts give the same hits.
+
+    Examples
+    --------
+    >>> pred_list = np.array([[2, 0], [1, 3]])
+    >>> hit_matrix(pred_list, np.array([[1, 0, 1, 0], [0, 0, 0, 1]], dtype=bool), 2)
+    array([[1., 1.],
+           [0., 1.]], dtype=float32)
+    >>> csr = (np.array([0, 2, 3]), np.array([0, 2, 3]))
+    >>> hit_matrix(pred_list, csr, 2)
+    array([[1., 1.],
+           [0., 1.]], dtype=float32)
+    >>> _csr_hits_numpy(pred_list, *csr, 2)
+    array([[1., 1.],
+           [0., 1.]], dtype=float32)
+    """
+    if isinstance(test_items, tuple):
+        indptr, indices = test_items
+        return _csr_hits(pred_list, indptr, indices, k)
+    return test_items[np.arange(len(pred_list))[:, None], pred_list[:, :k]].astype(np.float32)
+
+def recall_at_k(hits, gt):
+    # users without held-out items are excluded
+    users = gt > 0
+    return np.mean(hits[users].sum(1) / gt[users])
+
+def ndcg_at_k(hits, gt, discount):
+    # relevance is binary, so the DCG gain 2^rel - 1 reduces to rel
+    k = hits.shape[1]
+    dcg = hits @ discount[:k]
+    users = gt > 0
+    idcg = np.cumsum(discount[:k])[np.minimum(gt[users], k) - 1]
+    return np.mean(dcg[users] / idcg)
+
+def bpr_loss(p_score, n_score):
+    return F.softplus(n_score - p_score.unsqueeze(1)).mean()
+
 # if  __name__ == '__main__':
 #     dataset_name = 'Yelp'
 #     rec_dataset = TestRecData(dataset_name)